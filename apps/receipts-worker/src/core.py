@@ -1,8 +1,10 @@
+import functools
 import hashlib
 import os
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseSettings, validator
 
@@ -16,6 +18,7 @@ class Settings(BaseSettings):
     receipts_table: str = "receipts"
     receipt_items_table: str = "receipt_items"
     apps_table: str = "apps"
+    trust_filename_hash: bool = False
 
     @validator("receipts_root", pre=True)
     def _expand_root(cls, v):
@@ -51,16 +54,60 @@ class Settings(BaseSettings):
 
     class Config:
         env_prefix = ""
+        frozen = True
+        allow_mutation = False
 
 
-def sha256_file(path: Path) -> str:
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    # Validators expand/resolve paths and read fallback env vars; do it once per process.
+    return Settings()
+
+
+_HASH_CHUNK_SIZE = 4 * 1024 * 1024
+_SHA256_RE = re.compile(r"(?:^|[^0-9a-f])([0-9a-f]{64})(?:[^0-9a-f]|$)", re.I)
+
+
+def _sha256_file_legacy(path: Path) -> str:
+    # Python < 3.11 has no hashlib.file_digest.
     h = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+    with path.open("rb", buffering=0) as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
             h.update(chunk)
     return h.hexdigest()
 
 
+@dataclass(frozen=True)
+class FileMeta:
+    __slots__ = ("path", "size", "mtime_ns")
+
+    path: Path
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def from_path(cls, path: Path) -> "FileMeta":
+        st = path.stat()
+        return cls(path=path, size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+
+def sha256_file(meta: FileMeta, trust_filename: bool = False) -> str:
+    if trust_filename:
+        match = _SHA256_RE.search(meta.path.name)
+        if match:
+            return match.group(1).lower()
+    return _sha256_file_cached(meta)
+
+
+@functools.lru_cache(maxsize=4096)
+def _sha256_file_cached(meta: FileMeta) -> str:
+    # FileMeta carries mtime/size, so a rewritten file misses the cache and is hashed again.
+    if not hasattr(hashlib, "file_digest"):
+        return _sha256_file_legacy(meta.path)
+    with meta.path.open("rb", buffering=0) as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
 @dataclass
 class DbResult:
     ok: bool
@@ -79,3 +126,14 @@ class FileResult:
     items_count: int = 0
     total: Optional[float] = None
     discount_total: Optional[float] = None
+
+
+@dataclass
+class PreparedFile:
+    img_path: Path
+    parsed: Dict[str, Any]
+    db_result: DbResult
+    items_payload: List[dict] = field(default_factory=list)
+    items_count: int = 0
+    # Receipt row still waiting for insert_prepared_receipts (batched runs only).
+    receipt_payload: Optional[dict] = None
@@ -1,118 +1,136 @@
 import datetime as dt
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Set
 
-from tenacity import RetryError, retry, stop_after_attempt, wait_exponential
-
-from .core import DbResult, FileResult, Settings, sha256_file
+from .core import DbResult, FileMeta, FileResult, PreparedFile, Settings, sha256_file
 from .storage import move_file, write_json
 
 
-def _build_items_payload(items: list, owner_id: str, receipt_id: str) -> list:
-    normalized = []
-    for item in items:
-        if not isinstance(item, dict):
-            continue
-        meta = {}
-        for key, value in item.items():
-            if key in {
-                "name",
-                "quantity",
-                "unit",
-                "unit_price",
-                "paid_amount",
-                "discount",
-                "needs_review",
-                "is_food",
-                "food_quality",
-            }:
-                continue
-            meta[key] = value
-        normalized.append(
-            {
-                "owner_id": owner_id,
-                "receipt_id": receipt_id,
-                "name": item.get("name"),
-                "quantity": item.get("quantity"),
-                "unit": item.get("unit"),
-                "unit_price": item.get("unit_price"),
-                "paid_amount": item.get("paid_amount"),
-                "discount": item.get("discount") or 0.0,
-                "needs_review": bool(item.get("needs_review")),
-                "is_food": True if item.get("is_food") is None else bool(item.get("is_food")),
-                "food_quality": None if item.get("is_food") is False else item.get("food_quality"),
-                "meta": meta,
-            }
-        )
-    return normalized
-
-
-def _apply_food_hints(items: list, hints: dict) -> list:
-    if not hints:
-        return items
-    enriched = []
-    for item in items:
-        if not isinstance(item, dict):
-            enriched.append(item)
-            continue
-        name = item.get("name")
-        if not isinstance(name, str):
-            enriched.append(item)
-            continue
-        key = name.strip().lower()
-        hint = hints.get(key)
-        if not hint:
-            enriched.append(item)
-            continue
+_ITEM_KEYS = frozenset(
+    {
+        "name",
+        "quantity",
+        "unit",
+        "unit_price",
+        "paid_amount",
+        "discount",
+        "needs_review",
+        "is_food",
+        "food_quality",
+    }
+)
 
-        updated = dict(item)
-        if updated.get("is_food") is None and hint.get("is_food") is not None:
-            updated["is_food"] = hint.get("is_food")
 
-        if updated.get("is_food") is False:
-            updated["food_quality"] = None
-        elif updated.get("food_quality") is None and hint.get("food_quality") is not None:
-            updated["food_quality"] = hint.get("food_quality")
+def _make_item(item: dict, owner_id: str, receipt_id: str, hints: dict) -> dict:
+    is_food = item.get("is_food")
+    food_quality = item.get("food_quality")
 
-        enriched.append(updated)
-    return enriched
+    name = item.get("name")
+    # Hint keys are already stripped/lowercased by fetch_item_food_hints.
+    hint = hints.get(name.strip().lower()) if hints and isinstance(name, str) else None
+    if hint:
+        if is_food is None:
+            is_food = hint.get("is_food")
+        if is_food is not False and food_quality is None:
+            food_quality = hint.get("food_quality")
 
+    # Missing is_food defaults to True; only an explicit False clears food_quality.
+    is_food_flag = True if is_food is None else bool(is_food)
+    if is_food is False:
+        food_quality = None
 
-def _build_failure_payload(store: str, img_path: Path, error_code: str, message: str) -> Dict[str, Any]:
     return {
-        "schema_version": 3,
-        "store": store,
-        "timestamp": None,
-        "currency": "RON",
-        "total": 0.0,
-        "discount_total": 0.0,
-        "sgr_bottle_charge": 0.0,
-        "sgr_recovered_amount": 0.0,
-        "items": [],
-        "merchant": {},
-        "processing": {
-            "status": "fail",
-            "warnings": [],
-            "error": {"code": error_code, "message": message},
-        },
-        "source": {
-            "file_name": img_path.name,
-            "store_folder": store,
-            "rel_path": str(Path("inbox") / store / img_path.name),
-        },
+        "owner_id": owner_id,
+        "receipt_id": receipt_id,
+        "name": name,
+        "quantity": item.get("quantity"),
+        "unit": item.get("unit"),
+        "unit_price": item.get("unit_price"),
+        "paid_amount": item.get("paid_amount"),
+        "discount": item.get("discount") or 0.0,
+        "needs_review": bool(item.get("needs_review")),
+        "is_food": is_food_flag,
+        "food_quality": food_quality,
+        "meta": {key: value for key, value in item.items() if key not in _ITEM_KEYS},
+    }
+
+
+def _build_items_payload(items: list, owner_id: str, receipt_id: str, hints: Optional[dict] = None) -> list:
+    # Food hints are applied while building each row, so items are walked once.
+    return [_make_item(item, owner_id, receipt_id, hints) for item in items if isinstance(item, dict)]
+
+
+_FAILURE_TEMPLATE: Dict[str, Any] = {
+    "schema_version": 3,
+    "timestamp": None,
+    "currency": "RON",
+    "total": 0.0,
+    "discount_total": 0.0,
+    "sgr_bottle_charge": 0.0,
+    "sgr_recovered_amount": 0.0,
+}
+
+
+def _build_failure_payload(
+    store: str, img_path: Path, error_code: str, message: str, rel_path: str
+) -> Dict[str, Any]:
+    payload = _FAILURE_TEMPLATE.copy()
+    # Mutable members are created per call so failure payloads never share state.
+    payload["store"] = store
+    payload["items"] = []
+    payload["merchant"] = {}
+    payload["processing"] = {
+        "status": "fail",
+        "warnings": [],
+        "error": {"code": error_code, "message": message},
+    }
+    payload["source"] = {
+        "file_name": img_path.name,
+        "store_folder": store,
+        "rel_path": rel_path,
     }
+    return payload
+
+
+def _db_message(dry_run: bool, no_db: bool, db_result: DbResult) -> str:
+    if dry_run:
+        return "dry-run"
+    if no_db:
+        return "db skipped"
+    if db_result.skipped:
+        return "dedup"
+    return "db ok" if db_result.ok else "db error"
 
 
 def _now_iso() -> str:
-    return dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    return dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+_PARSE_ATTEMPTS = 3
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10))
 def _parse_with_retry(parser, img_path: Path, store: str, rel_base: str) -> Dict[str, Any]:
+    # Exponential backoff (1s, 2s, ... capped at 10s); the final attempt raises as-is.
+    for attempt in range(_PARSE_ATTEMPTS - 1):
+        try:
+            return parser.parse(img_path, store=store, rel_base=rel_base)
+        except Exception:
+            time.sleep(min(10, 1 << attempt))
     return parser.parse(img_path, store=store, rel_base=rel_base)
 
 
-def process_image(
+def parse_image(img_path: Path, store: str, parser) -> dict:
+    """Run the store parser on one image; exceptions become a failure payload."""
+    try:
+        return _parse_with_retry(parser, img_path, store=store, rel_base="inbox")
+    except Exception as exc:
+        rel_path = f"inbox/{store}/{img_path.name}"
+        return _build_failure_payload(store, img_path, "PARSER_EXCEPTION", str(exc), rel_path)
+
+
+def prepare_image(
     img_path: Path,
     store: str,
     config: Settings,
@@ -120,28 +138,32 @@ def process_image(
     db_client,
     dry_run: bool,
     no_db: bool,
-    move_files: bool,
-    write_json_files: bool,
-) -> FileResult:
-    source_hash = sha256_file(img_path)
+    source_hash: Optional[str] = None,
+    parsed: Optional[dict] = None,
+    known_hashes: Optional[Set[str]] = None,
+) -> PreparedFile:
+    """Parse one image (unless parsed is given) and upsert its receipt row.
 
-    try:
-        parsed = _parse_with_retry(parser, img_path, store=store, rel_base="inbox")
-    except RetryError as exc:
-        last_exc = exc.last_attempt.exception()
-        parsed = _build_failure_payload(
-            store,
-            img_path,
-            "PARSER_EXCEPTION",
-            str(last_exc) if last_exc else str(exc),
-        )
-    except Exception as exc:
-        parsed = _build_failure_payload(store, img_path, "PARSER_EXCEPTION", str(exc))
+    With known_hashes (prefetched existing source hashes) the duplicate check is done
+    in memory and the insert is left to insert_prepared_receipts.
+
+    Item rows are built but not inserted; see insert_prepared_items.
+    """
+    rel_path = f"inbox/{store}/{img_path.name}"
+    if parsed is None:
+        parsed = parse_image(img_path, store, parser)
 
     processing = parsed.get("processing", {})
     processing_status = processing.get("status", "fail")
+    items_input = parsed.get("items") or []
 
-    db_result = DbResult(ok=True, skipped=True)
+    prepared = PreparedFile(
+        img_path=img_path,
+        parsed=parsed,
+        db_result=DbResult(ok=True, skipped=True),
+        items_count=len(items_input),
+    )
+    db_result = prepared.db_result
     if not dry_run and not no_db:
         if not (config.supabase_url and config.supabase_key and config.owner_id):
             db_result = DbResult(ok=False, skipped=False, error="Missing Supabase config")
@@ -151,65 +173,191 @@ def process_image(
             if processing_status == "fail":
                 db_result = DbResult(ok=False, skipped=False, error="Processing status fail")
             else:
-                merchant = parsed.get("merchant") or {}
-                source = parsed.get("source") or {}
-                receipt_date = parsed.get("timestamp")
+                pget = parsed.get
+                merchant = pget("merchant") or {}
+                source = pget("source") or {}
+                receipt_date = pget("timestamp")
                 if not receipt_date:
                     db_result = DbResult(ok=False, skipped=False, error="Missing receipt timestamp")
                 else:
+                    # Only the DB dedup key needs the hash, so dry-run/no-db never read the file for it.
+                    if source_hash is None:
+                        source_hash = sha256_file(
+                            FileMeta.from_path(img_path), trust_filename=config.trust_filename_hash
+                        )
+                    merchant_get = merchant.get
                     receipt_payload = {
                         "owner_id": config.owner_id,
                         "store": store,
                         "receipt_date": receipt_date,
-                        "currency": parsed.get("currency") or "RON",
-                        "total_amount": parsed.get("total") or 0.0,
-                        "discount_total": parsed.get("discount_total") or 0.0,
-                        "sgr_bottle_charge": parsed.get("sgr_bottle_charge") or 0.0,
-                        "sgr_recovered_amount": parsed.get("sgr_recovered_amount") or 0.0,
-                        "merchant_name": merchant.get("name"),
-                        "merchant_city": merchant.get("city"),
-                        "merchant_cif": merchant.get("cif"),
+                        "currency": pget("currency") or "RON",
+                        "total_amount": pget("total") or 0.0,
+                        "discount_total": pget("discount_total") or 0.0,
+                        "sgr_bottle_charge": pget("sgr_bottle_charge") or 0.0,
+                        "sgr_recovered_amount": pget("sgr_recovered_amount") or 0.0,
+                        "merchant_name": merchant_get("name"),
+                        "merchant_city": merchant_get("city"),
+                        "merchant_cif": merchant_get("cif"),
                         "processing_status": "warn" if processing_status == "warn" else "ok",
                         "processing_warnings": processing.get("warnings") or [],
                         "source_file_name": source.get("file_name") or img_path.name,
-                        "source_rel_path": source.get("rel_path") or str(Path("inbox") / store / img_path.name),
+                        "source_rel_path": source.get("rel_path") or rel_path,
                         "source_hash": source_hash,
-                        "schema_version": parsed.get("schema_version") or 3,
+                        "schema_version": pget("schema_version") or 3,
                     }
-                    db_result = db_client.upsert_receipt(receipt_payload, config.owner_id, store, source_hash)
-                    if db_result.ok and not db_result.skipped and db_result.receipt_id:
-                        items_input = parsed.get("items") or []
-                        names = [
-                            item.get("name")
-                            for item in items_input
-                            if isinstance(item, dict) and item.get("name")
-                        ]
-                        hints = db_client.fetch_item_food_hints(config.owner_id, names)
-                        items_payload = _build_items_payload(
-                            _apply_food_hints(items_input, hints),
-                            config.owner_id,
-                            db_result.receipt_id,
-                        )
-                        items_result = db_client.insert_items(items_payload)
-                        if not items_result.ok:
-                            db_result = DbResult(ok=False, skipped=False, error=items_result.error, receipt_id=db_result.receipt_id)
+                    if known_hashes is not None:
+                        if source_hash in known_hashes:
+                            db_result = DbResult(ok=True, skipped=True)
+                        else:
+                            db_result = DbResult(ok=True, skipped=False)
+                            prepared.receipt_payload = receipt_payload
+                    else:
+                        db_result = db_client.insert_receipt(receipt_payload)
+                        prepared.db_result = db_result
+                        if db_result.ok and not db_result.skipped and db_result.receipt_id:
+                            _attach_items(prepared, db_client, config.owner_id)
+
+    prepared.db_result = db_result
+    return prepared
+
+
+def _attach_items(prepared: PreparedFile, db_client, owner_id: str) -> None:
+    items_input = prepared.parsed.get("items") or []
+    names = [
+        name
+        for item in items_input
+        if isinstance(item, dict) and (name := item.get("name"))
+    ]
+    hints = db_client.fetch_item_food_hints(owner_id, names)
+    prepared.items_payload = _build_items_payload(
+        items_input,
+        owner_id,
+        prepared.db_result.receipt_id,
+        hints,
+    )
+
+
+def insert_prepared_receipts(prepared: List[PreparedFile], db_client, owner_id: str, known_hashes: Set[str]) -> None:
+    """Insert the pending receipt rows of a batch with one request, then build their item rows.
+
+    If the batch insert fails, the rows are retried one by one so a bad row only fails its own file.
+    Files repeating content already inserted (or known) are skipped as duplicates.
+    """
+    pending: List[PreparedFile] = []
+    repeats: List[PreparedFile] = []
+    batch_hashes: Set[str] = set()
+    for entry in prepared:
+        payload = entry.receipt_payload
+        if payload is None:
+            continue
+        if payload["source_hash"] in batch_hashes:
+            repeats.append(entry)
+        else:
+            batch_hashes.add(payload["source_hash"])
+            pending.append(entry)
+
+    results = db_client.bulk_insert_receipts([entry.receipt_payload for entry in pending])
+    if not all(result.ok for result in results):
+        results = [db_client.insert_receipt(entry.receipt_payload) for entry in pending]
+
+    inserted = [entry for entry, result in zip(pending, results) if _finish_receipt(entry, result, known_hashes)]
+    for entry in repeats:
+        if entry.receipt_payload["source_hash"] in known_hashes:
+            _finish_receipt(entry, DbResult(ok=True, skipped=True), known_hashes)
+        elif _finish_receipt(entry, db_client.insert_receipt(entry.receipt_payload), known_hashes):
+            inserted.append(entry)
+    _attach_items_concurrently(inserted, db_client, owner_id)
+
+
+def _finish_receipt(entry: PreparedFile, result: DbResult, known_hashes: Set[str]) -> bool:
+    """Record a receipt insert result; True if the receipt was inserted and needs its item rows."""
+    entry.db_result = result
+    source_hash = entry.receipt_payload["source_hash"]
+    entry.receipt_payload = None
+    if result.ok and not result.skipped:
+        known_hashes.add(source_hash)
+        return bool(result.receipt_id)
+    return False
+
+
+_DB_WORKERS = 4
+
+
+def _attach_items_concurrently(entries: List[PreparedFile], db_client, owner_id: str) -> None:
+    # Each receipt's food-hints lookup is a network round trip; overlap them.
+    if len(entries) <= 1:
+        for entry in entries:
+            _attach_items(entry, db_client, owner_id)
+        return
+    with ThreadPoolExecutor(max_workers=min(_DB_WORKERS, len(entries))) as pool:
+        list(pool.map(lambda entry: _attach_items(entry, db_client, owner_id), entries))
+
+
+_ITEMS_PAGE_ROWS = 500
+
+
+def insert_prepared_items(prepared: List[PreparedFile], db_client) -> None:
+    """Insert the item rows of several receipts in pages of up to _ITEMS_PAGE_ROWS rows.
+
+    A receipt's rows never span two pages. If a page fails, its receipts are retried one by one
+    so only a receipt whose own rows fail is marked as a DB error.
+    """
+    page: List[PreparedFile] = []
+    page_rows = 0
+    for entry in prepared:
+        if not entry.items_payload:
+            continue
+        if page and page_rows + len(entry.items_payload) > _ITEMS_PAGE_ROWS:
+            _insert_items_page(page, db_client)
+            page, page_rows = [], 0
+        page.append(entry)
+        page_rows += len(entry.items_payload)
+    if page:
+        _insert_items_page(page, db_client)
+
+
+def _insert_items_page(page: List[PreparedFile], db_client) -> None:
+    items_result = db_client.insert_items([row for entry in page for row in entry.items_payload])
+    if items_result.ok:
+        return
+    if len(page) == 1:
+        _mark_items_failed(page[0], items_result)
+        return
+    # The receipt rows are already committed, so failing the whole page would orphan good receipts.
+    for entry in page:
+        entry_result = db_client.insert_items(entry.items_payload)
+        if not entry_result.ok:
+            _mark_items_failed(entry, entry_result)
+
+
+def _mark_items_failed(entry: PreparedFile, items_result: DbResult) -> None:
+    entry.db_result = DbResult(
+        ok=False, skipped=False, error=items_result.error, receipt_id=entry.db_result.receipt_id
+    )
+
+
+def finalize_image(
+    prepared: PreparedFile,
+    store: str,
+    config: Settings,
+    dry_run: bool,
+    no_db: bool,
+    move_files: bool,
+    write_json_files: bool,
+) -> FileResult:
+    """Move the image and write its JSON artifact based on the parse/DB outcome."""
+    img_path = prepared.img_path
+    parsed = prepared.parsed
+    db_result = prepared.db_result
+    processing = parsed.get("processing", {})
+    processing_status = processing.get("status", "fail")
 
     if processing_status == "fail" or not db_result.ok:
         outcome = "failed"
     else:
         outcome = "processed"
 
-    message = ""
-    if dry_run:
-        message = "dry-run"
-    elif no_db:
-        message = "db skipped"
-    elif db_result.skipped:
-        message = "dedup"
-    elif db_result.ok:
-        message = "db ok"
-    else:
-        message = "db error"
+    message = _db_message(dry_run, no_db, db_result)
 
     details = []
     if processing_status == "fail":
@@ -241,11 +389,10 @@ def process_image(
                     },
                     "data": parsed,
                 }
-                write_json(moved_path.with_suffix(moved_path.suffix + ".error.json"), error_payload)
+                write_json(moved_path.parent / (moved_path.name + ".error.json"), error_payload)
             else:
-                write_json(moved_path.with_suffix(moved_path.suffix + ".json"), parsed)
+                write_json(moved_path.parent / (moved_path.name + ".json"), parsed)
 
-    items_count = len(parsed.get("items", []) or [])
     total_value = parsed.get("total")
     discount_total = parsed.get("discount_total")
 
@@ -255,7 +402,25 @@ def process_image(
         outcome=outcome,
         db_result=db_result,
         message=message,
-        items_count=items_count,
+        items_count=prepared.items_count,
         total=total_value,
         discount_total=discount_total,
     )
+
+
+def process_image(
+    img_path: Path,
+    store: str,
+    config: Settings,
+    parser,
+    db_client,
+    dry_run: bool,
+    no_db: bool,
+    move_files: bool,
+    write_json_files: bool,
+    source_hash: Optional[str] = None,
+) -> FileResult:
+    prepared = prepare_image(img_path, store, config, parser, db_client, dry_run, no_db, source_hash)
+    if prepared.items_payload:
+        insert_prepared_items([prepared], db_client)
+    return finalize_image(prepared, store, config, dry_run, no_db, move_files, write_json_files)
@@ -4,19 +4,25 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import functools
+import hashlib
+import itertools
 import json
 import os
 import re
 import sys
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 try:
-    import pillow_heif  # type: ignore
-    pillow_heif.register_heif_opener()
+    import orjson  # type: ignore
 except Exception:
-    pass
+    orjson = None
 
 
 SUPPORTED_EXTS = {".png", ".jpg", ".jpeg", ".heic", ".webp", ".tif", ".tiff"}
@@ -36,28 +42,72 @@ def _pd(msg: str) -> None:
 # Helpers
 # ----------------------------
 
+# Parsing helpers normalize the same OCR lines over and over; cache both str -> str steps.
+@functools.lru_cache(maxsize=4096)
 def _norm_spaces(s: str) -> str:
-    s = s.replace("\u00a0", " ")
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    # str.split() splits on the same Unicode whitespace as \s (NBSP included) and drops the ends.
+    return " ".join(s.split())
+
+
+# Romanian diacritics (both comma and cedilla forms) and NBSP cover almost all non-ASCII receipt text.
+_DIACRITIC_TABLE = str.maketrans(
+    {
+        "ă": "a",
+        "â": "a",
+        "î": "i",
+        "ș": "s",
+        "ş": "s",
+        "ț": "t",
+        "ţ": "t",
+        "Ă": "A",
+        "Â": "A",
+        "Î": "I",
+        "Ș": "S",
+        "Ş": "S",
+        "Ț": "T",
+        "Ţ": "T",
+        "\u00a0": " ",
+    }
+)
 
 
 def _strip_diacritics(s: str) -> str:
-    import unicodedata
+    # NFKD leaves ASCII untouched, and most receipt lines are plain ASCII.
+    if s.isascii():
+        return s
+    s = s.translate(_DIACRITIC_TABLE)
+    if s.isascii():
+        return s
+    # Anything else (other accents, ligatures, ...) goes through full NFKD.
     return "".join(c for c in unicodedata.normalize("NFKD", s) if not unicodedata.combining(c))
 
 
+@functools.lru_cache(maxsize=4096)
 def _upper_ascii(s: str) -> str:
     return _strip_diacritics(s).upper()
 
 
 _MONEY_RE = re.compile(r"(\d{1,3}(?:[.\s]\d{3})*[.,]\s*\d{2})")
+_QTY_INNER_RE = re.compile(r"(\d+[.,]\d+)")
+# Most lines are names/markers without digits or a decimal separator; both patterns below
+# need one of each, and these C-level checks are cheaper than entering the regex.
+_HAS_DIGIT_RE = re.compile(r"\d")
+
+
+def _may_hold_decimal(text: str) -> bool:
+    return ("," in text or "." in text) and _HAS_DIGIT_RE.search(text) is not None
 
 
 def parse_money(text: str) -> Optional[float]:
+    if not _may_hold_decimal(text):
+        return None
     m = _MONEY_RE.search(text)
     if not m:
         return None
+    return _money_value(m)
+
+
+def _money_value(m: re.Match) -> Optional[float]:
     raw = m.group(1).replace(" ", "").replace(".", "").replace(",", ".")
     try:
         return float(raw)
@@ -66,7 +116,9 @@ def parse_money(text: str) -> Optional[float]:
 
 
 def parse_quantity(text: str) -> Optional[float]:
-    m = re.search(r"(\d+[.,]\d+)", text)
+    if not _may_hold_decimal(text):
+        return None
+    m = _QTY_INNER_RE.search(text)
     if not m:
         return None
     raw = m.group(1).replace(",", ".")
@@ -76,6 +128,8 @@ def parse_quantity(text: str) -> Optional[float]:
         return None
 
 
+# Coerces to float for values from outside the parser (JSON output); parse paths that
+# already hold floats call round(x, 2) directly to skip the extra call.
 def money_round(x: float) -> float:
     return round(float(x), 2)
 
@@ -90,6 +144,8 @@ class OcrResult:
     method: str
 
 
+# Vision/Quartz availability cannot change within a process; ocr_image asks once per file.
+@functools.lru_cache(maxsize=1)
 def _vision_available() -> bool:
     try:
         import Vision  # type: ignore
@@ -99,6 +155,47 @@ def _vision_available() -> bool:
         return False
 
 
+# One configured request per thread: Vision requests are reusable across images
+# (each perform replaces results()) but must not be shared between threads.
+_VISION_TLS = threading.local()
+
+
+def _vision_request() -> Any:
+    req = getattr(_VISION_TLS, "request", None)
+    if req is None:
+        import Vision  # type: ignore
+
+        req = Vision.VNRecognizeTextRequest.alloc().init()
+        req.setRecognitionLevel_(Vision.VNRequestTextRecognitionLevelAccurate)
+        try:
+            req.setRecognitionLanguages_(["ro-RO", "en-US"])
+        except Exception:
+            pass
+        req.setUsesLanguageCorrection_(True)
+        _VISION_TLS.request = req
+    return req
+
+
+@functools.lru_cache(maxsize=1)
+def warm_up_vision() -> None:
+    """Recognize a blank image once so the text model is loaded before the first receipt."""
+    if not _vision_available():
+        return
+    try:
+        import Vision  # type: ignore
+        import Quartz  # type: ignore
+
+        ctx = Quartz.CGBitmapContextCreate(
+            None, 32, 32, 8, 0, Quartz.CGColorSpaceCreateDeviceGray(), Quartz.kCGImageAlphaNone
+        )
+        blank = Quartz.CGBitmapContextCreateImage(ctx)
+        handler = Vision.VNImageRequestHandler.alloc().initWithCGImage_options_(blank, None)
+        handler.performRequests_error_([_vision_request()], None)
+    except Exception:
+        # Only a head start; real OCR errors surface per image.
+        pass
+
+
 def ocr_image_vision(image_path: Path) -> OcrResult:
     import Vision  # type: ignore
     import Quartz  # type: ignore
@@ -113,31 +210,26 @@ def ocr_image_vision(image_path: Path) -> OcrResult:
     if cg_img is None:
         raise RuntimeError(f"Could not decode image: {image_path}")
 
-    req = Vision.VNRecognizeTextRequest.alloc().init()
-    req.setRecognitionLevel_(Vision.VNRequestTextRecognitionLevelAccurate)
-    try:
-        req.setRecognitionLanguages_(["ro-RO", "en-US"])
-    except Exception:
-        pass
-    req.setUsesLanguageCorrection_(True)
-
+    req = _vision_request()
     handler = Vision.VNImageRequestHandler.alloc().initWithCGImage_options_(cg_img, None)
     ok = handler.performRequests_error_([req], None)[0]
     if not ok:
         raise RuntimeError("Vision OCR failed")
 
     obs = req.results() or []
-    rows: List[Tuple[float, float, str]] = []
+    # (-y, x, arrival index, text): a plain tuple sort gives top-to-bottom, left-to-right
+    # order, and the index keeps ties stable without comparing text or calling a key function.
+    rows: List[Tuple[float, float, int, str]] = []
     for o in obs:
         try:
             txt = str(o.topCandidates_(1)[0].string())
         except Exception:
             continue
         bb = o.boundingBox()
-        rows.append((float(bb.origin.y), float(bb.origin.x), _norm_spaces(txt)))
+        rows.append((-float(bb.origin.y), float(bb.origin.x), len(rows), _norm_spaces(txt)))
 
-    rows.sort(key=lambda t: (-t[0], t[1]))
-    lines = [t[2] for t in rows if t[2]]
+    rows.sort()
+    lines = [t[3] for t in rows if t[3]]
     return OcrResult(text="\n".join(lines), method="apple_vision")
 
 
@@ -147,6 +239,28 @@ def ocr_image(image_path: Path) -> OcrResult:
     return ocr_image_vision(image_path)
 
 
+def ocr_image_cached(image_path: Path, cache_dir: Optional[Path]) -> OcrResult:
+    """ocr_image with a content-addressed cache of the OCR text in cache_dir (if set).
+
+    Re-runs over the same folder skip Vision for images whose bytes have not changed.
+    """
+    if cache_dir is None:
+        return ocr_image(image_path)
+
+    key = hashlib.blake2b(image_path.read_bytes(), digest_size=16).hexdigest()
+    cache_path = cache_dir / f"{key}.json"
+    try:
+        cached = json.loads(cache_path.read_text(encoding="utf-8"))
+        return OcrResult(text=cached["text"], method=cached["method"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    ocr = ocr_image(image_path)
+    ensure_dir(cache_dir)
+    cache_path.write_text(json.dumps({"text": ocr.text, "method": ocr.method}, ensure_ascii=False), encoding="utf-8")
+    return ocr
+
+
 # ----------------------------
 # Parsing (receipt is source of truth)
 # ----------------------------
@@ -157,6 +271,58 @@ _QTY_LINE_RE = re.compile(
 )
 
 
+_CIF_RE = re.compile(r"\d{8}")
+_NON_DIGIT_RE = re.compile(r"\D")
+_DATA_RE = re.compile(r"DATA\s*[: ]\s*([0-9]{2})/([0-9]{2})/([0-9]{4})")
+_ORA_RE = re.compile(r"[0O]RA\s*[: ]\s*([0-9]{2})[-: ]([0-9]{2})[-: ]([0-9]{2})")
+
+
+@dataclass
+class ReceiptItem:
+    """One parsed receipt line item; converted to a dict only for the JSON output."""
+
+    __slots__ = (
+        "name",
+        "quantity",
+        "quantity_raw",
+        "unit",
+        "unit_price",
+        "unit_price_raw",
+        "paid_amount",
+        "paid_amount_raw",
+        "discount",
+        "discount_raw",
+        "needs_review",
+    )
+
+    name: Optional[str]
+    quantity: Optional[float]
+    quantity_raw: str
+    unit: str
+    unit_price: Optional[float]
+    unit_price_raw: str
+    paid_amount: Optional[float]
+    paid_amount_raw: Optional[str]
+    discount: float
+    discount_raw: Optional[str]
+    needs_review: bool
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "quantity": self.quantity,
+            "quantity_raw": self.quantity_raw,
+            "unit": self.unit,
+            "unit_price": self.unit_price,
+            "unit_price_raw": self.unit_price_raw,
+            "paid_amount": self.paid_amount,
+            "paid_amount_raw": self.paid_amount_raw,
+            "discount": self.discount,
+            "discount_raw": self.discount_raw,
+            "needs_review": self.needs_review,
+        }
+
+
 def is_returnare_garantie(line: str) -> bool:
     u = _upper_ascii(line)
     return ("RETURNARE" in u and "GARANT" in u)
@@ -172,20 +338,26 @@ def extract_merchant(lines: List[str]) -> Dict[str, Optional[str]]:
         u = _upper_ascii(line)
         if name is None and "LIDL" in u:
             name = _norm_spaces(line)
-        if cif is None and re.fullmatch(r"\d{8}", line.strip()):
-            cif = line.strip()
+        if cif is None:
+            stripped = line.strip()
+            # A CIF line is exactly eight digits; the length test rejects almost every line cheaply.
+            if len(stripped) == 8 and _CIF_RE.fullmatch(stripped):
+                cif = stripped
         if address is None and (u.startswith("STRADA") or u.startswith("BULEVARDUL")):
             address = _norm_spaces(line)
             if idx + 1 < len(lines):
                 city = _norm_spaces(lines[idx + 1])
+        if name is not None and cif is not None and address is not None:
+            # Every field is first-match-wins, so later lines cannot change the result.
+            break
 
     return {"name": name, "address": address, "city": city, "cif": cif}
 
 
 def _clean_time_triplet(h: str, m: str, s: str) -> Tuple[str, str, str]:
-    h = re.sub(r"\D", "0", h)
-    m = re.sub(r"\D", "0", m)
-    s = re.sub(r"\D", "0", s)
+    h = _NON_DIGIT_RE.sub("0", h)
+    m = _NON_DIGIT_RE.sub("0", m)
+    s = _NON_DIGIT_RE.sub("0", s)
     return h, m, s
 
 
@@ -196,11 +368,11 @@ def extract_timestamp(lines: List[str]) -> Optional[str]:
     for line in lines:
         u = _upper_ascii(line)
 
-        m = re.search(r"DATA\s*[: ]\s*([0-9]{2})/([0-9]{2})/([0-9]{4})", u)
+        m = _DATA_RE.search(u)
         if m:
             date_s = f"{m.group(3)}-{m.group(2)}-{m.group(1)}"
 
-        m = re.search(r"[0O]RA\s*[: ]\s*([0-9]{2})[-: ]([0-9]{2})[-: ]([0-9]{2})", u)
+        m = _ORA_RE.search(u)
         if m:
             hh, mm, ss = _clean_time_triplet(m.group(1), m.group(2), m.group(3))
             time_s = f"{hh}:{mm}:{ss}"
@@ -212,38 +384,47 @@ def extract_timestamp(lines: List[str]) -> Optional[str]:
     return None
 
 
-def _find_lei_section(lines: List[str]) -> int:
-    for i, ln in enumerate(lines):
-        if _upper_ascii(ln) == "LEI":
-            return i
-    return -1
+# Lines that end the LEI amount column (payment/footer block).
+_LEI_END_PREFIX_RE = re.compile(r"(?:TRANZAC|CASA|MG|DATA|TZ/POS|ORA|BON|MULTUMESC|ACHIZIT|DETALII)")
+
+
+def _find_lei_section(upper_lines: List[str]) -> int:
+    """Index of the "LEI" header in lines already passed through _upper_ascii, or -1."""
+    try:
+        return upper_lines.index("LEI")
+    except ValueError:
+        return -1
 
 
 def _extract_amount_stream_from_lei(lines: List[str]) -> List[Tuple[float, str]]:
-    start = _find_lei_section(lines)
+    upper_lines = [_upper_ascii(ln) for ln in lines]
+    start = _find_lei_section(upper_lines)
     if start < 0:
         return []
     out: List[Tuple[float, str]] = []
-    for ln in lines[start + 1 :]:
-        u = _upper_ascii(ln)
+    for ln, u in zip(lines[start + 1 :], upper_lines[start + 1 :]):
+        nl = _norm_spaces(ln)
         # Guard: OCR sometimes interleaves left-column qty lines into the LEI section.
         # We must NOT treat those as monetary tokens.
-        if _QTY_LINE_RE.match(_norm_spaces(ln)):
+        if _QTY_LINE_RE.match(nl):
             continue
-        uu = _upper_ascii(_norm_spaces(ln))
+        uu = _upper_ascii(nl)
         if ("BUC" in uu or "KG" in uu) and (" X " in f" {uu} " or "×" in uu or " X" in uu):
             continue
-        if u.startswith(("TRANZAC", "CASA", "MG", "DATA", "TZ/POS", "ORA", "BON", "MULTUMESC", "ACHIZIT", "DETALII")):
+        if _LEI_END_PREFIX_RE.match(u):
             break
-        if not _MONEY_RE.search(_norm_spaces(ln)):
+        money_m = _MONEY_RE.search(nl) if _may_hold_decimal(nl) else None
+        if not money_m:
             continue
-        v = parse_money(ln)
+        # Lines from process_one are already normalized, so the gate match is the amount;
+        # otherwise parse the raw line as before (spacing can change what the regex sees).
+        v = _money_value(money_m) if nl == ln else parse_money(ln)
         if v is None:
             continue
         raw_compact = ln.replace(" ", "")
         if "-" in raw_compact:
             v = -abs(v)
-        out.append((money_round(v), ln))
+        out.append((round(v, 2), ln))
     return out
 
 
@@ -251,14 +432,24 @@ def _extract_amount_stream_from_lei(lines: List[str]) -> List[Tuple[float, str]]
 # Discount/duplicate helpers (inserted)
 # ----------------------------
 
+_VAT_TAIL_RE = re.compile(r"\b([ABD])\b\s*$")
+_VAT_TAIL_STRIP_RE = re.compile(r"\b[ABD]\b\s*$", re.IGNORECASE)
+_VAT_D_TAIL_RE = re.compile(r"\bD\b\s*$")
+_ALPHA_RE = re.compile(r"[A-ZĂÂÎȘŞȚŢ]")
+_LEADING_NOISE_RE = re.compile(r"^[^0-9\-]+")
+_TRAILING_NOISE_RE = re.compile(r"[^0-9.,\-\s]+$")
+_MONEY_FULL_RE = re.compile(r"-?\d{1,3}(?:[.\s]\d{3})*[.,]\s*\d{2}")
+_NUMERIC_ONLY_RE = re.compile(r"[0-9.,\-\s]+")
+
+
 def _vat_from_raw_token(raw: str) -> Optional[str]:
     ru = _upper_ascii(_norm_spaces(raw))
-    m = re.search(r"\b([ABD])\b\s*$", ru)
+    m = _VAT_TAIL_RE.search(ru)
     return m.group(1) if m else None
 
 
 def attach_discounts_from_lei(
-    items: List[Dict[str, Any]],
+    items: List[ReceiptItem],
     lei_tokens: List[Tuple[float, str]],
 ) -> float:
     """Attach item-level discounts from the LEI section.
@@ -281,43 +472,46 @@ def attach_discounts_from_lei(
 
     # Reset any existing discounts to avoid mixing strategies.
     for it in items:
-        it["discount"] = float(it.get("discount") or 0.0)
-        it["discount_raw"] = it.get("discount_raw")
+        it.discount = float(it.discount or 0.0)
+
+    # Split the tokens into plain lists once; the walk below only indexes them.
+    vals = [v for v, _ in lei_tokens]
+    raws = [raw for _, raw in lei_tokens]
+    # Rounded positive amounts; None for tokens that can never be a paid amount.
+    paid_keys = [round(v, 2) if v > 0 else None for v in vals]
+    n_tok = len(vals)
 
     # We walk the LEI token list once, in order.
     ti = 0
     discount_total = 0.0
 
     for it in items:
-        paid = it.get("paid_amount")
+        paid = it.paid_amount
         if paid is None:
             continue
         try:
-            paid_v = money_round(float(paid))
+            paid_v = round(float(paid), 2)
         except Exception:
             continue
 
         # Advance until we find the next matching positive token.
-        found = False
-        while ti < len(lei_tokens):
-            v, raw = lei_tokens[ti]
-            if v > 0 and money_round(v) == paid_v:
-                found = True
-                break
+        while ti < n_tok and paid_keys[ti] != paid_v:
             ti += 1
 
-        if not found:
-            continue
+        if ti >= n_tok:
+            # Tokens exhausted; no later item can match either.
+            break
 
         # Candidate discount is the next token.
-        if ti + 1 < len(lei_tokens):
-            nv, nraw = lei_tokens[ti + 1]
+        if ti + 1 < n_tok:
+            nv = vals[ti + 1]
             if nv < 0:
+                nraw = raws[ti + 1]
                 vat = _vat_from_raw_token(nraw)
                 if vat != "D":
                     disc = abs(float(nv))
-                    it["discount"] = money_round(disc)
-                    it["discount_raw"] = _norm_spaces(nraw)
+                    it.discount = round(disc, 2)
+                    it.discount_raw = _norm_spaces(nraw)
                     discount_total += disc
                     ti = ti + 2
                     continue
@@ -325,15 +519,15 @@ def attach_discounts_from_lei(
         # No discount for this item; move past the paid token.
         ti += 1
 
-    return money_round(discount_total)
+    return round(discount_total, 2)
 
 
-def _needs_review_from_item(it: Dict[str, Any]) -> bool:
+def _needs_review_from_item(it: ReceiptItem) -> bool:
     # Mark items that are incomplete/missing paid_amount.
-    return it.get("paid_amount") is None
+    return it.paid_amount is None
 
 
-def dedupe_incomplete_duplicates(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def dedupe_incomplete_duplicates(items: List[ReceiptItem]) -> List[ReceiptItem]:
     """Remove obvious OCR-duplicate items.
 
     Safe heuristic (does not compute):
@@ -346,35 +540,34 @@ def dedupe_incomplete_duplicates(items: List[Dict[str, Any]]) -> List[Dict[str,
     if not items:
         return items
 
-    out: List[Dict[str, Any]] = []
+    out: List[ReceiptItem] = []
+    # Each item's name is normalized once; the previous kept item's key is carried along.
+    prev_key = None
     for it in items:
-        if out:
-            prev = out[-1]
-            same_core = (
-                _norm_spaces(str(prev.get("name") or "")) == _norm_spaces(str(it.get("name") or ""))
-                and prev.get("unit") == it.get("unit")
-                and prev.get("quantity") == it.get("quantity")
-                and prev.get("unit_price") == it.get("unit_price")
-            )
-            if same_core:
-                prev_incomplete = prev.get("paid_amount") is None
-                cur_incomplete = it.get("paid_amount") is None
-                if prev_incomplete and not cur_incomplete:
-                    out[-1] = it
-                    continue
-                if cur_incomplete and not prev_incomplete:
-                    continue
+        key = (_norm_spaces(str(it.name or "")), it.unit, it.quantity, it.unit_price)
+        if out and key == prev_key:
+            prev_incomplete = out[-1].paid_amount is None
+            cur_incomplete = it.paid_amount is None
+            if prev_incomplete and not cur_incomplete:
+                out[-1] = it
+                continue
+            if cur_incomplete and not prev_incomplete:
+                continue
         out.append(it)
+        prev_key = key
 
     return out
 
 
-def extract_totals(lines: List[str]) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+def extract_totals(
+    lines: List[str],
+    lei_tokens: Optional[List[Tuple[float, str]]] = None,
+) -> Tuple[Optional[float], Optional[float], Optional[float]]:
     total = None
     subtotal = None
     total_tva = None
 
-    lei = _extract_amount_stream_from_lei(lines)
+    lei = lei_tokens if lei_tokens is not None else _extract_amount_stream_from_lei(lines)
     positives = [v for (v, _) in lei if v > 0]
     if positives:
         total = positives[-1]
@@ -386,189 +579,288 @@ def extract_totals(lines: List[str]) -> Tuple[Optional[float], Optional[float],
             for j in range(i + 1, min(len(lines), i + 40)):
                 v = parse_money(lines[j])
                 if v is not None:
-                    total_tva = money_round(v)
+                    total_tva = round(v, 2)
                     break
             break
 
     return total, subtotal, total_tva
 
 
-def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], float]:
-    """Parse receipt items using an item-centric state machine.
+# ----------------------------
+# Line classifiers used by parse_items
+# ----------------------------
 
-    Supports non-stable OCR ordering seen on LIDL receipts:
-      - Pattern A: q_line -> name -> paid
-      - Pattern B: q_line -> paid -> name
-      - Pattern C: q_line -> (vat-only noise) -> name -> paid
-      - Pattern D: item + paid followed by REDUCERE/DISCOUNT block with negative amount
+_FOOTER_PREFIX_RE = re.compile(r"(?:TVA|TRANZAC|CASA|MG|DATA|TZ/POS|ORA|BON|MUL[ȚT]UMESC|ACHIZIT|DETALII)")
 
-    The receipt is the source of truth: we extract, we do not recompute.
-    """
 
-    items: List[Dict[str, Any]] = []
-    warnings: List[str] = []
+def _upper_norm(s: str) -> str:
+    return _upper_ascii(_norm_spaces(s))
+
+
+def is_totals_marker(s: str) -> bool:
+    return _upper_norm(s).startswith(("SUBTOTAL", "TOTAL", "TOTAL TVA"))
+
+
+def is_discount_marker(s: str) -> bool:
+    return _upper_norm(s).startswith("DISCOUNT")
+
+
+def is_discount_prelude(s: str) -> bool:
+    uu = _upper_norm(s)
+    return uu.startswith("REDUCERE") or ("REDUCERE" in uu and "LIDL" in uu and "PLUS" in uu)
 
-    def u(s: str) -> str:
-        return _upper_ascii(_norm_spaces(s))
-
-    def is_totals_marker(s: str) -> bool:
-        return u(s).startswith(("SUBTOTAL", "TOTAL", "TOTAL TVA"))
-
-    def is_discount_marker(s: str) -> bool:
-        return u(s).startswith("DISCOUNT")
-
-    def is_discount_prelude(s: str) -> bool:
-        uu = u(s)
-        return uu.startswith("REDUCERE") or ("REDUCERE" in uu and "LIDL" in uu and "PLUS" in uu)
-
-    def is_footer_noise(s: str) -> bool:
-        uu = u(s)
-        if not uu:
-            return True
-        if uu in {"CARD", "LEI", "A", "B", "D"}:
-            return True
-        if uu.startswith(
-            (
-                "TVA",
-                "TRANZAC",
-                "CASA",
-                "MG",
-                "DATA",
-                "TZ/POS",
-                "ORA",
-                "BON",
-                "MULTUMESC",
-                "MULȚUMESC",
-                "ACHIZIT",
-                "DETALII",
-            )
-        ):
-            return True
-        return False
 
-    def _line_is_vat_only(s: str) -> Optional[str]:
-        ss = _norm_spaces(s)
-        if ss in {"A", "B", "D"}:
-            return ss
-        uu = u(ss)
-        if uu in {"A", "B", "D"} and len(uu) == 1:
-            return uu
+def is_footer_noise(s: str) -> bool:
+    uu = _upper_norm(s)
+    if not uu:
+        return True
+    if uu in {"CARD", "LEI", "A", "B", "D"}:
+        return True
+    if _FOOTER_PREFIX_RE.match(uu):
+        return True
+    return False
+
+
+def _line_is_vat_only(s: str) -> Optional[str]:
+    ss = _norm_spaces(s)
+    if ss in {"A", "B", "D"}:
+        return ss
+    uu = _upper_norm(ss)
+    if uu in {"A", "B", "D"} and len(uu) == 1:
+        return uu
+    return None
+
+
+def _parse_money_vat_inline(s: str) -> Optional[Tuple[float, str, str]]:
+    """Return (value, vat_code, name_part) if line contains money + VAT letter.
+
+    name_part is the remaining text with the money+vat removed (can be empty).
+    """
+    ss = _norm_spaces(s)
+    money_m = _MONEY_RE.search(ss)
+    mm = _money_value(money_m) if money_m else None
+    if mm is None:
+        return None
+    # VAT letter at end (possibly separated)
+    su = _upper_norm(ss)
+    mvat = _VAT_TAIL_RE.search(su)
+    if not mvat:
         return None
+    vat = mvat.group(1)
 
-    def _parse_money_vat_inline(s: str) -> Optional[Tuple[float, str, str]]:
-        """Return (value, vat_code, name_part) if line contains money + VAT letter.
+    val = mm
+    if "-" in ss.replace(" ", ""):
+        val = -abs(val)
+    val = round(val, 2)
 
-        name_part is the remaining text with the money+vat removed (can be empty).
-        """
-        ss = _norm_spaces(s)
-        mm = parse_money(ss)
-        if mm is None:
-            return None
-        # VAT letter at end (possibly separated)
-        su = u(ss)
-        mvat = re.search(r"\b([ABD])\b\s*$", su)
-        if not mvat:
-            return None
-        vat = mvat.group(1)
-
-        val = mm
-        if "-" in ss.replace(" ", ""):
+    # Remove the last money occurrence and trailing VAT to get a potential name part.
+    # Keep this conservative to avoid deleting product names that contain numbers.
+    # Cutting out the span found above is what _MONEY_RE.sub(..., count=1) would do, minus a second scan.
+    name_part = (ss[: money_m.start()] + ss[money_m.end() :]).strip()
+    name_part = _VAT_TAIL_STRIP_RE.sub("", name_part).strip()
+    return val, vat, name_part
+
+
+def _parse_money_then_vat(tbl: "_LineTable", idx: int) -> Optional[Tuple[float, str, int]]:
+    """Parse split tokens across two lines.
+
+    Supports both:
+      - amount then VAT-only (e.g. `12,19` + `B`)
+      - VAT-only then amount (e.g. `B` + `12,19`)
+
+    Returns (value, vat, consumed_lines).
+    """
+    if idx + 1 >= len(tbl.norm):
+        return None
+
+    # Case 1: amount then VAT
+    mm_a = tbl.money[idx]
+    vat_b = tbl.vat_only[idx + 1]
+    if mm_a is not None and vat_b:
+        val = mm_a
+        if "-" in tbl.norm[idx]:
+            val = -abs(val)
+        return round(val, 2), vat_b, 2
+
+    # Case 2: VAT then amount
+    vat_a = tbl.vat_only[idx]
+    mm_b = tbl.money[idx + 1]
+    if vat_a and mm_b is not None:
+        val = mm_b
+        if "-" in tbl.norm[idx + 1]:
             val = -abs(val)
-        val = money_round(val)
-
-        # Remove the last money occurrence and trailing VAT to get a potential name part.
-        # Keep this conservative to avoid deleting product names that contain numbers.
-        name_part = ss
-        name_part = _MONEY_RE.sub("", name_part, count=1).strip()
-        name_part = re.sub(r"\b[ABD]\b\s*$", "", name_part, flags=re.IGNORECASE).strip()
-        return val, vat, name_part
-
-    def _parse_money_then_vat(lines_: List[str], idx: int) -> Optional[Tuple[float, str, int]]:
-        """Parse split tokens across two lines.
-
-        Supports both:
-          - amount then VAT-only (e.g. `12,19` + `B`)
-          - VAT-only then amount (e.g. `B` + `12,19`)
-
-        Returns (value, vat, consumed_lines).
-        """
-        if idx >= len(lines_):
-            return None
-        if idx + 1 >= len(lines_):
-            return None
-
-        a = _norm_spaces(lines_[idx])
-        b = _norm_spaces(lines_[idx + 1])
-
-        # Case 1: amount then VAT
-        mm_a = parse_money(a)
-        vat_b = _line_is_vat_only(b)
-        if mm_a is not None and vat_b:
-            val = mm_a
-            if "-" in a.replace(" ", ""):
-                val = -abs(val)
-            return money_round(val), vat_b, 2
-
-        # Case 2: VAT then amount
-        vat_a = _line_is_vat_only(a)
-        mm_b = parse_money(b)
-        if vat_a and mm_b is not None:
-            val = mm_b
-            if "-" in b.replace(" ", ""):
-                val = -abs(val)
-            return money_round(val), vat_a, 2
+        return round(val, 2), vat_a, 2
+
+    return None
+
 
+def _parse_money_only(s: str) -> Optional[float]:
+    """Parse a money value from a line that may contain only the amount (no VAT).
+
+    We accept small OCR noise around the number (e.g. trailing ')'), but the line must not
+    contain letters.
+    """
+    ss = _norm_spaces(s)
+    mm = parse_money(ss)
+    if mm is None:
         return None
 
-    def _parse_money_only(s: str) -> Optional[float]:
-        """Parse a money value from a line that may contain only the amount (no VAT).
+    uu = _upper_ascii(ss)
+    # Must not contain letters (VAT letters handled elsewhere).
+    if _ALPHA_RE.search(uu):
+        return None
 
-        We accept small OCR noise around the number (e.g. trailing ')'), but the line must not
-        contain letters.
-        """
-        ss = _norm_spaces(s)
-        mm = parse_money(ss)
-        if mm is None:
-            return None
+    # Remove common leading/trailing noise characters and re-check the shape.
+    uu2 = _LEADING_NOISE_RE.sub("", uu)
+    uu2 = _TRAILING_NOISE_RE.sub("", uu2)
+    uu2 = uu2.strip()
 
-        uu = _upper_ascii(ss)
-        # Must not contain letters (VAT letters handled elsewhere).
-        if re.search(r"[A-ZĂÂÎȘŞȚŢ]", uu):
-            return None
+    if not _MONEY_FULL_RE.fullmatch(uu2):
+        return None
 
-        # Remove common leading/trailing noise characters and re-check the shape.
-        uu2 = re.sub(r"^[^0-9\-]+", "", uu)
-        uu2 = re.sub(r"[^0-9.,\-\s]+$", "", uu2)
-        uu2 = uu2.strip()
+    val = mm
+    if "-" in ss.replace(" ", ""):
+        val = -abs(val)
+    return round(val, 2)
 
-        if not re.fullmatch(r"-?\d{1,3}(?:[.\s]\d{3})*[.,]\s*\d{2}", uu2):
-            return None
 
-        val = mm
-        if "-" in ss.replace(" ", ""):
-            val = -abs(val)
-        return money_round(val)
+def _looks_like_money_noise(s: str) -> bool:
+    # Lines like "7,99 B" are handled by _parse_money_vat_inline; this is for pure numeric leftovers.
+    ss = _norm_spaces(s)
+    if parse_money(ss) is None:
+        return False
+    # If the line is basically just a number (possibly with separators), treat as not-a-name.
+    uu = _upper_norm(ss)
+    return bool(_NUMERIC_ONLY_RE.fullmatch(uu))
+
+
+def _take_negative_amount(tbl: "_LineTable", k_idx: int) -> Optional[Tuple[float, str, int, Optional[str]]]:
+    """Return (abs_value, raw_text, consumed_lines, vat_code_if_known) for a negative amount."""
+    line0 = tbl.norm[k_idx]
+
+    # inline negative with VAT
+    ni = tbl.inline[k_idx]
+    if ni is not None and ni[0] < 0:
+        return abs(ni[0]), line0, 1, ni[1]
+
+    # money-only negative
+    mo = tbl.money_only[k_idx]
+    if mo is not None and mo < 0:
+        return abs(mo), line0, 1, None
+
+    # split across two lines (either order)
+    ns = _parse_money_then_vat(tbl, k_idx)
+    if ns is not None and ns[0] < 0:
+        raw = line0 + " " + tbl.norm[k_idx + 1]
+        return abs(ns[0]), raw, ns[2], ns[1]
 
-    def _looks_like_money_noise(s: str) -> bool:
-        # Lines like "7,99 B" are handled by _parse_money_vat_inline; this is for pure numeric leftovers.
-        ss = _norm_spaces(s)
-        if parse_money(ss) is None:
-            return False
-        # If the line is basically just a number (possibly with separators), treat as not-a-name.
-        uu = u(ss)
-        return bool(re.fullmatch(r"[0-9.,\-\s]+", uu))
+    return None
+
+
+# Line kinds for _LineTable.flags; a line can carry several.
+_LINE_TOTALS = 1
+_LINE_QTY = 2
+_LINE_FOOTER = 4
+_LINE_DISCOUNT_PRELUDE = 8
+_LINE_DISCOUNT_MARKER = 16
+_LINE_ITEM_END = _LINE_TOTALS | _LINE_QTY
+_LINE_SKIP = _LINE_FOOTER | _LINE_DISCOUNT_PRELUDE | _LINE_DISCOUNT_MARKER
+
+
+@dataclass
+class _LineTable:
+    """Classification of every receipt line, one list entry per line.
+
+    Money fields are only filled in for lines where parse_money finds an amount.
+    """
+
+    norm: List[str]
+    flags: List[int]
+    qty: List[Optional[re.Match]]
+    vat_only: List[Optional[str]]
+    money: List[Optional[float]]
+    inline: List[Optional[Tuple[float, str, str]]]
+    money_only: List[Optional[float]]
+    money_noise: List[bool]
+    returnare: List[bool]
+
+
+def _scan_lines(lines: List[str]) -> _LineTable:
+    n = len(lines)
+    tbl = _LineTable(
+        norm=[_norm_spaces(ln) for ln in lines],
+        flags=[0] * n,
+        qty=[None] * n,
+        vat_only=[None] * n,
+        money=[None] * n,
+        inline=[None] * n,
+        money_only=[None] * n,
+        money_noise=[False] * n,
+        returnare=[False] * n,
+    )
+    for idx, ss in enumerate(tbl.norm):
+        f = 0
+        if is_totals_marker(ss):
+            f |= _LINE_TOTALS
+        m = _QTY_LINE_RE.match(ss)
+        if m:
+            f |= _LINE_QTY
+            tbl.qty[idx] = m
+        if is_footer_noise(ss):
+            f |= _LINE_FOOTER
+        if is_discount_prelude(ss):
+            f |= _LINE_DISCOUNT_PRELUDE
+        if is_discount_marker(ss):
+            f |= _LINE_DISCOUNT_MARKER
+        tbl.flags[idx] = f
+        tbl.vat_only[idx] = _line_is_vat_only(ss)
+        tbl.returnare[idx] = is_returnare_garantie(ss)
+        mm = parse_money(ss)
+        if mm is not None:
+            tbl.money[idx] = mm
+            tbl.inline[idx] = _parse_money_vat_inline(ss)
+            tbl.money_only[idx] = _parse_money_only(ss)
+            tbl.money_noise[idx] = _looks_like_money_noise(ss)
+    return tbl
+
+
+def parse_items(
+    lines: List[str],
+    lei_tokens: Optional[List[Tuple[float, str]]] = None,
+) -> Tuple[List[ReceiptItem], List[str], float]:
+    """Parse receipt items using an item-centric state machine.
+
+    Supports non-stable OCR ordering seen on LIDL receipts:
+      - Pattern A: q_line -> name -> paid
+      - Pattern B: q_line -> paid -> name
+      - Pattern C: q_line -> (vat-only noise) -> name -> paid
+      - Pattern D: item + paid followed by REDUCERE/DISCOUNT block with negative amount
+
+    The receipt is the source of truth: we extract, we do not recompute.
+
+    Pass lei_tokens (from _extract_amount_stream_from_lei) to avoid rescanning the LEI section.
+    """
+
+    items: List[ReceiptItem] = []
+    warnings: List[str] = []
 
     sgr_recovered = 0.0
 
     pending_vat: Optional[str] = None
 
+    # Phase 1: classify every line once. Phase 2 below only reads the table.
+    tbl = _scan_lines(lines)
+    norm = tbl.norm
+    flags = tbl.flags
+    n = len(norm)
+
     i = 0
-    while i < len(lines):
-        ln = _norm_spaces(lines[i])
-        if is_totals_marker(ln):
+    while i < n:
+        ln = norm[i]
+        if flags[i] & _LINE_TOTALS:
             break
 
-        m = _QTY_LINE_RE.match(ln)
+        m = tbl.qty[i]
         if not m:
             i += 1
             continue
@@ -594,48 +886,43 @@ def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], floa
         # Move to the next line after qty line and collect until we can close the item.
         j = i + 1
         skipped = 0
-        while j < len(lines):
-            cand = _norm_spaces(lines[j])
+        while j < n:
+            cand = norm[j]
+            fj = flags[j]
 
-            if is_totals_marker(cand) or _QTY_LINE_RE.match(cand):
-                # If we already have both, we can stop collecting for this item.
-                if cur_name is not None and cur_paid is not None:
-                    break
+            if fj & _LINE_ITEM_END:
                 break
 
-            if is_footer_noise(cand):
-                j += 1
-                skipped += 1
-                continue
-
-            # Ignore prelude lines; DISCOUNT itself is handled after closing the item.
-            if is_discount_prelude(cand) or is_discount_marker(cand):
+            # Footer noise and REDUCERE/DISCOUNT lines; DISCOUNT itself is handled after closing the item.
+            if fj & _LINE_SKIP:
                 j += 1
                 skipped += 1
                 continue
 
             # Handle VAT-only lines: set pending_vat and skip
-            vat_only = _line_is_vat_only(cand)
+            vat_only = tbl.vat_only[j]
             if vat_only is not None:
                 pending_vat = vat_only
-                _pd(f"[vat] pending_vat={pending_vat} line='{cand}'")
+                if _PARSE_DEBUG:
+                    _pd(f"[vat] pending_vat={pending_vat} line='{cand}'")
                 j += 1
                 skipped += 1
                 continue
 
             # Handle returnare garantie: do not create an item; skip forward to next qty/totals.
-            if cur_name is None and is_returnare_garantie(cand):
-                _pd(f"[skip] returnare_garantie after q_line='{ln}'")
+            if cur_name is None and tbl.returnare[j]:
+                if _PARSE_DEBUG:
+                    _pd(f"[skip] returnare_garantie after q_line='{ln}'")
                 # Advance to the next qty line / totals marker
                 j += 1
-                while j < len(lines) and (not _QTY_LINE_RE.match(_norm_spaces(lines[j]))) and (not is_totals_marker(_norm_spaces(lines[j]))):
+                while j < n and not flags[j] & _LINE_ITEM_END:
                     j += 1
                 cur_name = None
                 cur_paid = None
                 break
 
             # 1) Paid amount can be inline (e.g., "7,99 B")
-            mv = _parse_money_vat_inline(cand)
+            mv = tbl.inline[j]
             if mv is not None:
                 val, vat, name_part = mv
                 # Only accept positive values as paid for the current item
@@ -645,42 +932,46 @@ def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], floa
                     cur_paid_raw = cand
                     if cur_name is None and name_part and not _looks_like_money_noise(name_part):
                         cur_name = name_part
-                    _pd(f"[paid] inline val={cur_paid} vat={cur_vat} line='{cand}'")
+                    if _PARSE_DEBUG:
+                        _pd(f"[paid] inline val={cur_paid} vat={cur_vat} line='{cand}'")
                     j += 1
                     # don't close yet; name might come after (Pattern B)
                     continue
                 # Negative values are discounts/SGR handled later (only after close)
 
             # 2) Paid amount can be split across two lines: "12,19" then "B"
-            mv2 = _parse_money_then_vat(lines, j)
+            mv2 = _parse_money_then_vat(tbl, j)
             if mv2 is not None:
                 val, vat, consumed = mv2
                 if val > 0 and cur_paid is None:
                     cur_paid = val
                     cur_vat = vat
-                    cur_paid_raw = _norm_spaces(lines[j]) + " " + _norm_spaces(lines[j + 1])
-                    _pd(f"[paid] split val={cur_paid} vat={cur_vat} line='{cur_paid_raw}'")
+                    cur_paid_raw = cand + " " + norm[j + 1]
+                    if _PARSE_DEBUG:
+                        _pd(f"[paid] split val={cur_paid} vat={cur_vat} line='{cur_paid_raw}'")
                     j += consumed
                     continue
 
             # 3) Paid amount as numeric-only, possibly with pending VAT
-            mv3 = _parse_money_only(cand)
+            mv3 = tbl.money_only[j]
             if mv3 is not None and cur_paid is None:
                 # paid amount without VAT letter; use pending_vat if we saw it, otherwise keep None
                 if mv3 > 0:
                     cur_paid = mv3
                     cur_vat = pending_vat
                     cur_paid_raw = cand if pending_vat is None else f"{cand} {pending_vat}"
-                    _pd(f"[paid] money_only val={cur_paid} vat={cur_vat} line='{cur_paid_raw}'")
+                    if _PARSE_DEBUG:
+                        _pd(f"[paid] money_only val={cur_paid} vat={cur_vat} line='{cur_paid_raw}'")
                     pending_vat = None
                     j += 1
                     continue
                 # negative money-only lines are discounts/SGR handled outside the item-close path
 
             # 4) Otherwise, treat as name candidate (but never accept obvious money noise)
-            if cur_name is None and not _looks_like_money_noise(cand) and not _line_is_vat_only(cand):
+            if cur_name is None and not tbl.money_noise[j]:
                 cur_name = cand
-                _pd(f"[name] '{cur_name}'")
+                if _PARSE_DEBUG:
+                    _pd(f"[name] '{cur_name}'")
                 j += 1
                 continue
 
@@ -691,26 +982,16 @@ def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], floa
         # At this point, we may have a complete item.
         if cur_name is None or cur_paid is None:
             # If this was a returnare_garantie skip, just advance.
-            if cur_name is None and cur_paid is None and j > i + 1 and (j < len(lines)) and (_QTY_LINE_RE.match(_norm_spaces(lines[j])) or is_totals_marker(_norm_spaces(lines[j]))):
+            if cur_name is None and cur_paid is None and j > i + 1 and j < n and flags[j] & _LINE_ITEM_END:
                 i = j
                 continue
             warnings.append(
                 f"Incomplete item after qty line '{ln}' (name={cur_name!r}, paid={cur_paid!r})"
             )
-            _pd(f"[warn] incomplete item q_line='{ln}' name={cur_name!r} paid={cur_paid!r} pending_vat={pending_vat!r}")
-            ctx = []
-            for t in range(i + 1, min(len(lines), i + 6)):
-                ctx.append(_norm_spaces(lines[t]))
-            _pd(f"[warn_ctx] after '{ln}' -> {ctx}")
-            i = i + 1
-            continue
-
-        # If the close condition wasn't reached inside the loop, ensure it's true now.
-        # (Pattern B can set paid before name; loop keeps going until it finds name or stops.)
-        if cur_name is None or cur_paid is None:
-            warnings.append(
-                f"Incomplete item after qty line '{ln}' (name={cur_name!r}, paid={cur_paid!r})"
-            )
+            if _PARSE_DEBUG:
+                _pd(f"[warn] incomplete item q_line='{ln}' name={cur_name!r} paid={cur_paid!r} pending_vat={pending_vat!r}")
+                ctx = norm[i + 1 : min(n, i + 6)]
+                _pd(f"[warn_ctx] after '{ln}' -> {ctx}")
             i = i + 1
             continue
 
@@ -728,39 +1009,15 @@ def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], floa
         # We attach at most ONE discount to the just-closed item.
 
         # skip any number of REDUCERE / Lidl Plus lines
-        while k < len(lines) and is_discount_prelude(_norm_spaces(lines[k])):
+        while k < n and flags[k] & _LINE_DISCOUNT_PRELUDE:
             k += 1
 
         # optional DISCOUNT marker
-        if k < len(lines) and is_discount_marker(_norm_spaces(lines[k])):
+        if k < n and flags[k] & _LINE_DISCOUNT_MARKER:
             k += 1
 
-        if k < len(lines):
-            nxt = _norm_spaces(lines[k])
-
-            def _take_negative_amount(k_idx: int) -> Optional[Tuple[float, str, int, Optional[str]]]:
-                """Return (abs_value, raw_text, consumed_lines, vat_code_if_known) for a negative amount."""
-                line0 = _norm_spaces(lines[k_idx])
-
-                # inline negative with VAT
-                ni = _parse_money_vat_inline(line0)
-                if ni is not None and ni[0] < 0:
-                    return abs(ni[0]), line0, 1, ni[1]
-
-                # money-only negative
-                mo = _parse_money_only(line0)
-                if mo is not None and mo < 0:
-                    return abs(mo), line0, 1, None
-
-                # split across two lines (either order)
-                ns = _parse_money_then_vat(lines, k_idx)
-                if ns is not None and ns[0] < 0:
-                    raw = _norm_spaces(lines[k_idx]) + " " + _norm_spaces(lines[k_idx + 1])
-                    return abs(ns[0]), raw, ns[2], ns[1]
-
-                return None
-
-            taken = _take_negative_amount(k)
+        if k < n:
+            taken = _take_negative_amount(tbl, k)
             if taken is not None:
                 disc_val, disc_raw, consumed, disc_vat = taken
                 # VAT=D indicates SGR refund, not an item discount.
@@ -773,38 +1030,41 @@ def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], floa
                 k += consumed
 
         items.append(
-            {
-                "name": cur_name,
-                "quantity": qty,
-                "quantity_raw": qty_raw,
-                "unit": unit,
-                "unit_price": unit_price,
-                "unit_price_raw": unit_price_raw,
-                "paid_amount": cur_paid,
-                "paid_amount_raw": cur_paid_raw,
-                "discount": cur_discount,
-                "discount_raw": cur_discount_raw,
-            }
+            ReceiptItem(
+                name=cur_name,
+                quantity=qty,
+                quantity_raw=qty_raw,
+                unit=unit,
+                unit_price=unit_price,
+                unit_price_raw=unit_price_raw,
+                paid_amount=cur_paid,
+                paid_amount_raw=cur_paid_raw,
+                discount=cur_discount,
+                discount_raw=cur_discount_raw,
+                needs_review=False,
+            )
         )
 
-        _pd(
-            f"[item] q_line='{ln}' name='{cur_name}' paid={cur_paid} vat={cur_vat} discount={cur_discount}"
-        )
+        if _PARSE_DEBUG:
+            _pd(
+                f"[item] q_line='{ln}' name='{cur_name}' paid={cur_paid} vat={cur_vat} discount={cur_discount}"
+            )
 
         # Advance: continue scanning from where we ended (k if we consumed discount, else j)
         i = max(i + 1, k)
 
     # ---- SGR recovered (negative D) ----
     # Prefer LEI stream tokens because that's where the refund is consistently printed.
-    try:
-        lei_tokens = _extract_amount_stream_from_lei(lines)
-    except Exception:
-        lei_tokens = []
+    if lei_tokens is None:
+        try:
+            lei_tokens = _extract_amount_stream_from_lei(lines)
+        except Exception:
+            lei_tokens = []
 
     # First pass: find a negative value whose raw line ends with VAT=D (inline)
     for v, raw in lei_tokens:
         ru = _upper_ascii(_norm_spaces(raw))
-        if v < 0 and re.search(r"\bD\b\s*$", ru):
+        if v < 0 and _VAT_D_TAIL_RE.search(ru):
             sgr_recovered = abs(v)
             break
 
@@ -812,22 +1072,20 @@ def parse_items(lines: List[str]) -> Tuple[List[Dict[str, Any]], List[str], floa
     #   -8,50
     #   D
     if sgr_recovered == 0.0:
-        for idx in range(len(lines) - 1):
-            a = _norm_spaces(lines[idx])
-            b = _norm_spaces(lines[idx + 1])
-            if b != "D":
+        for idx in range(n - 1):
+            if norm[idx + 1] != "D":
                 continue
-            vv = parse_money(a)
+            vv = tbl.money[idx]
             if vv is None:
                 continue
-            if "-" in a.replace(" ", ""):
+            if "-" in norm[idx]:
                 vv = -abs(vv)
-            vv = money_round(vv)
+            vv = round(vv, 2)
             if vv < 0:
                 sgr_recovered = abs(vv)
                 break
 
-    return items, warnings, money_round(sgr_recovered)
+    return items, warnings, round(sgr_recovered, 2)
 # ----------------------------
 # JSON builder
 # ----------------------------
@@ -885,57 +1143,74 @@ def build_json_schema_v3(
 # ----------------------------
 
 def iter_images(input_dir: Path) -> List[Path]:
-    return [p for p in sorted(input_dir.iterdir()) if p.is_file() and p.suffix.lower() in SUPPORTED_EXTS]
+    with os.scandir(input_dir) as entries:
+        return sorted(
+            Path(e.path) for e in entries
+            if os.path.splitext(e.name)[1].lower() in SUPPORTED_EXTS and e.is_file()
+        )
 
 
 def ensure_dir(p: Path) -> None:
     p.mkdir(parents=True, exist_ok=True)
 
 
+def write_out_json(path: Union[str, Path], payload: Dict[str, Any]) -> None:
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(payload, indent=2, ensure_ascii=False))
+
+
 def write_debug(logs_dir: Path, stem: str, content: str) -> None:
     ensure_dir(logs_dir)
-    (logs_dir / f"{stem}.debug.txt").write_text(content, encoding="utf-8")
+    with open(os.path.join(logs_dir, stem + ".debug.txt"), "w", encoding="utf-8") as f:
+        f.write(content)
 
 
-def process_one(image_path: Path, store: str, rel_base: str, debug: bool) -> Tuple[Dict[str, Any], str]:
-    dbg: List[str] = []
-    dbg.append(f"[FILE] {image_path.name}")
+def process_one(
+    image_path: Path,
+    store: str,
+    rel_base: str,
+    debug: bool,
+    ocr: Optional[OcrResult] = None,
+    with_log: bool = True,
+) -> Tuple[Dict[str, Any], str]:
+    """OCR + parse a single receipt. Pass ocr to parse an OcrResult produced elsewhere.
 
+    The returned log text is "" unless debug or with_log is set.
+    """
     global _PARSE_DEBUG, _PARSE_DEBUG_LINES
     _PARSE_DEBUG = bool(debug)
-    _PARSE_DEBUG_LINES = []
+    if debug:
+        _PARSE_DEBUG_LINES = []
 
-    ocr = ocr_image(image_path)
-    dbg.append(f"[OCR] method={ocr.method} chars={len(ocr.text)}")
+    if ocr is None:
+        ocr = ocr_image(image_path)
 
-    lines = [_norm_spaces(x) for x in ocr.text.splitlines() if _norm_spaces(x)]
+    lines = [norm for x in ocr.text.splitlines() if (norm := _norm_spaces(x))]
 
     merchant = extract_merchant(lines)
     timestamp = extract_timestamp(lines)
-    total, subtotal, total_tva = extract_totals(lines)
 
-    items, warnings, sgr_recovered = parse_items(lines)
+    # The LEI section is scanned once and shared by totals, SGR and discount extraction.
+    lei_tokens = _extract_amount_stream_from_lei(lines)
+    total, subtotal, total_tva = extract_totals(lines, lei_tokens)
+
+    items, warnings, sgr_recovered = parse_items(lines, lei_tokens)
 
     # Post-processing: attach discounts from LEI token stream (pure extraction).
     # This avoids global shifting and matches discounts that appear as negative LEI tokens.
-    try:
-        lei_tokens = _extract_amount_stream_from_lei(lines)
-    except Exception:
-        lei_tokens = []
-
     discount_total = attach_discounts_from_lei(items, lei_tokens)
 
     # Mark items that still need human review (e.g., OCR missed paid_amount).
     for it in items:
-        it["needs_review"] = _needs_review_from_item(it)
+        it.needs_review = _needs_review_from_item(it)
 
     # Safe dedupe for obvious OCR duplicates.
     items = dedupe_incomplete_duplicates(items)
 
-    if debug and _PARSE_DEBUG_LINES:
-        dbg.append("[PARSE_DEBUG]")
-        dbg.extend(_PARSE_DEBUG_LINES)
-
     sgr_charge = 0.0
 
     status = "ok"
@@ -946,17 +1221,26 @@ def process_one(image_path: Path, store: str, rel_base: str, debug: bool) -> Tup
     elif warnings:
         status = "warn"
 
-    dbg.append(f"[DT] timestamp={timestamp}")
-    dbg.append(f"[TOTALS] total={total} subtotal={subtotal} total_tva={total_tva} discount_total={discount_total:.2f}")
-    dbg.append(f"[SGR] recovered={sgr_recovered:.2f}")
-    dbg.append(f"[ITEMS] count={len(items)}")
-
-    if debug:
-        for idx, it in enumerate(items):
-            dbg.append(
-                f"  item[{idx}] q={it.get('quantity')} {it.get('unit')} unit_price={it.get('unit_price')} "
-                f"paid={it.get('paid_amount')} disc={it.get('discount')} needs_review={it.get('needs_review')} name='{it.get('name')}'"
-            )
+    # Only format the log when someone reads it (parse_file and the worker discard it).
+    dbg_text = ""
+    if debug or with_log:
+        dbg: List[str] = [f"[FILE] {image_path.name}", f"[OCR] method={ocr.method} chars={len(ocr.text)}"]
+        if debug and _PARSE_DEBUG_LINES:
+            dbg.append("[PARSE_DEBUG]")
+            dbg.extend(_PARSE_DEBUG_LINES)
+
+        dbg.append(f"[DT] timestamp={timestamp}")
+        dbg.append(f"[TOTALS] total={total} subtotal={subtotal} total_tva={total_tva} discount_total={discount_total:.2f}")
+        dbg.append(f"[SGR] recovered={sgr_recovered:.2f}")
+        dbg.append(f"[ITEMS] count={len(items)}")
+
+        if debug:
+            for idx, it in enumerate(items):
+                dbg.append(
+                    f"  item[{idx}] q={it.quantity} {it.unit} unit_price={it.unit_price} "
+                    f"paid={it.paid_amount} disc={it.discount} needs_review={it.needs_review} name='{it.name}'"
+                )
+        dbg_text = "\n".join(dbg) + "\n"
 
     out_json = build_json_schema_v3(
         store=store,
@@ -969,17 +1253,17 @@ def process_one(image_path: Path, store: str, rel_base: str, debug: bool) -> Tup
         discount_total=discount_total,
         sgr_charge=sgr_charge,
         sgr_recovered=sgr_recovered,
-        items=items,
+        items=[it.to_dict() for it in items],
         warnings=warnings,
         status=status,
         error=err,
     )
 
-    return out_json, "\n".join(dbg) + "\n"
+    return out_json, dbg_text
 
 
 def parse_file(image_path: Path, store: str = "lidl", rel_base: str = "inbox", debug: bool = False) -> Dict[str, Any]:
-    out_json, _dbg = process_one(Path(image_path), store=store, rel_base=rel_base, debug=debug)
+    out_json, _dbg = process_one(Path(image_path), store=store, rel_base=rel_base, debug=debug, with_log=False)
     return out_json
 
 
@@ -991,6 +1275,8 @@ def main(argv: Optional[List[str]] = None) -> int:
     ap.add_argument("--rel-base", default="inbox", help="rel_base to build source.rel_path (default: inbox)")
     ap.add_argument("--logs-dir", default=None, help="If set, write per-file debug logs here")
     ap.add_argument("--debug", action="store_true", help="Verbose debug logs")
+    ap.add_argument("--no-ocr-cache", action="store_true", help="Do not reuse OCR text cached under --logs-dir/ocr_cache")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parallel OCR threads (default: CPU count)")
 
     args = ap.parse_args(argv)
 
@@ -1006,26 +1292,56 @@ def main(argv: Optional[List[str]] = None) -> int:
     if logs_dir:
         ensure_dir(logs_dir)
 
+    # Output paths are built as plain strings per file rather than PurePath joins.
+    out_prefix = os.path.join(out_dir, "")
+
     images = iter_images(input_dir)
     if not images:
         print(f"[WARN] No images found in {input_dir} (supported: {sorted(SUPPORTED_EXTS)})")
         return 0
 
-    for img_path in images:
-        out_json, dbg = process_one(img_path, store=args.store, rel_base=args.rel_base, debug=args.debug)
+    # Vision releases the GIL while recognizing, so OCR runs on a thread pool.
+    # Parsing stays on this thread: the parse debug buffer is module-global.
+    cache_dir = logs_dir / "ocr_cache" if logs_dir and not args.no_ocr_cache else None
+    run_ocr = functools.partial(ocr_image_cached, cache_dir=cache_dir)
+    workers = max(1, args.workers)
+    # Load the model once here instead of in every OCR thread's first image at the same time.
+    warm_up_vision()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Producer/consumer: keep a bounded window of OCR jobs ahead of the parser, so OCR
+        # overlaps parsing without queueing every image (and its text) at once.
+        todo = iter(images)
+        in_flight: collections.deque = collections.deque()
+        for img_path in itertools.islice(todo, 2 * workers):
+            in_flight.append((img_path, pool.submit(run_ocr, img_path)))
+        while in_flight:
+            img_path, ocr_future = in_flight.popleft()
+            next_img = next(todo, None)
+            if next_img is not None:
+                in_flight.append((next_img, pool.submit(run_ocr, next_img)))
+            ocr = ocr_future.result()
+            out_json, dbg = process_one(
+                img_path,
+                store=args.store,
+                rel_base=args.rel_base,
+                debug=args.debug,
+                ocr=ocr,
+                with_log=logs_dir is not None,
+            )
 
-        stem = img_path.stem
-        (out_dir / f"{stem}.json").write_text(json.dumps(out_json, indent=2, ensure_ascii=False), encoding="utf-8")
+            name = img_path.name
+            stem = os.path.splitext(name)[0]
+            write_out_json(out_prefix + stem + ".json", out_json)
 
-        if logs_dir:
-            write_debug(logs_dir, stem, dbg)
+            if logs_dir:
+                write_debug(logs_dir, stem, dbg)
 
-        status = out_json.get("processing", {}).get("status")
-        total = out_json.get("total")
-        discount_total = out_json.get("discount_total")
-        sgr_rec = out_json.get("sgr_recovered_amount")
-        items_n = len(out_json.get("items", []))
-        print(f"[{str(status).upper()}] File {img_path.name} | total={total} | discount_total={discount_total} | sgr_recovered={sgr_rec} | items={items_n}")
+            status = out_json.get("processing", {}).get("status")
+            total = out_json.get("total")
+            discount_total = out_json.get("discount_total")
+            sgr_rec = out_json.get("sgr_recovered_amount")
+            items_n = len(out_json.get("items", []))
+            print(f"[{str(status).upper()}] File {name} | total={total} | discount_total={discount_total} | sgr_recovered={sgr_rec} | items={items_n}")
 
     return 0
 
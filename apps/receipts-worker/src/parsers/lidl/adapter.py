@@ -10,8 +10,11 @@ def _ensure_repo_root_on_path() -> None:
         sys.path.insert(0, str(receipts_src))
 
 
-def parse(img_path: Path, store: str, rel_base: str) -> Dict[str, Any]:
-    _ensure_repo_root_on_path()
-    from lidl_receipt_ocr import parse_file
+# Patch sys.path and import the parser once, at import time, instead of on every receipt.
+_ensure_repo_root_on_path()
+
+from lidl_receipt_ocr import parse_file  # noqa: E402
 
+
+def parse(img_path: Path, store: str, rel_base: str) -> Dict[str, Any]:
     return parse_file(Path(img_path), store=store, rel_base=rel_base)
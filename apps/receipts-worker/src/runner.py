@@ -1,8 +1,13 @@
 import argparse
+import atexit
 import datetime as dt
+import functools
 import json
 import os
+import sys
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, TextIO
 
 try:
     from dotenv import load_dotenv
@@ -11,12 +16,20 @@ except Exception:
 
 from pydantic import ValidationError
 
-from .core import Settings
+from .core import FileMeta, Settings, get_settings, sha256_file
 from .storage import ensure_dir, list_images, SupabaseClient
-from .ingest import process_image
+from .ingest import finalize_image, insert_prepared_items, insert_prepared_receipts, parse_image, prepare_image
 from .registry import get_parser, list_stores
 
 
+# Hashing releases the GIL, so the next files are hashed while the current one parses.
+_HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def _hash_image(img_path: Path, trust_filename: bool) -> str:
+    return sha256_file(FileMeta.from_path(img_path), trust_filename)
+
+
 def _parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Receipts worker")
     parser.add_argument("--store", help="Store key (e.g. lidl)")
@@ -27,15 +40,64 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument("--no-json", action="store_true", help="Do not write JSON artifacts")
     parser.add_argument("--root", help="Override receipts root path")
     parser.add_argument("--batch-size", type=int, default=10, help="Files per batch")
+    parser.add_argument("--workers", type=int, default=1, help="Parser processes (1 = parse in-process)")
     return parser.parse_args()
 
 
+# Open daily log files, kept for the whole run instead of reopened per line.
+# Line-buffered, so every record reaches disk even if the run hangs or is killed.
+_LOG_HANDLES: Dict[Path, TextIO] = {}
+
+
 def _log_line(logs_root: Path, message: str) -> None:
-    print(message)
-    ensure_dir(logs_root)
+    line = message + "\n"
+    sys.stdout.write(line)
     log_file = logs_root / f"{dt.date.today().isoformat()}.log"
-    with log_file.open("a", encoding="utf-8") as f:
-        f.write(message + "\n")
+    handle = _LOG_HANDLES.get(log_file)
+    if handle is None:
+        ensure_dir(logs_root)
+        handle = _LOG_HANDLES[log_file] = log_file.open("a", encoding="utf-8", buffering=1)
+    handle.write(line)
+
+
+def close_logs() -> None:
+    while _LOG_HANDLES:
+        _, handle = _LOG_HANDLES.popitem()
+        handle.close()
+
+
+atexit.register(close_logs)
+
+
+def _parse_in_worker(img_path: Path, store: str) -> dict:
+    # Parser modules do not pickle, so worker processes look the parser up themselves.
+    return parse_image(img_path, store, get_parser(store))
+
+
+class _InlineExecutor(Executor):
+    """Runs each submitted call right away on the calling thread."""
+
+    def submit(self, fn, *args, **kwargs):
+        future: Future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+def _parse_pool(workers: int, batch_size: int) -> Executor:
+    # --workers 1 parses serially in this process (pdb and tracebacks work as usual);
+    # the parse debug state is module-global, so parallel parsers need separate processes.
+    if workers <= 1:
+        return _InlineExecutor()
+    return ProcessPoolExecutor(max_workers=min(workers, batch_size))
+
+
+# One client per config for the whole process, so --all reuses its HTTP connection pool
+# (keep-alive, TLS session) instead of building a new one per store.
+@functools.lru_cache(maxsize=4)
+def _get_supabase_client(
+    url: str, key: str, receipts_table: str, receipt_items_table: str, apps_table: str
+) -> SupabaseClient:
+    return SupabaseClient(url, key, receipts_table, receipt_items_table, apps_table)
 
 
 def _app_slug(store: str) -> str:
@@ -50,14 +112,15 @@ def _status_summary(results) -> str:
     return f"total={total} ok={ok} warn={warn} fail={fail}"
 
 
-def process_store(store: str, args: argparse.Namespace) -> int:
-    if args.root:
-        os.environ["RECEIPTS_ROOT"] = args.root
+def _load_settings(args: argparse.Namespace) -> Settings:
     try:
-        settings = Settings()
+        # --root is passed to Settings directly (init values win over env) instead of via os.environ.
+        return Settings(receipts_root=args.root) if args.root else get_settings()
     except ValidationError as exc:
         raise SystemExit(str(exc)) from exc
 
+
+def process_store(store: str, args: argparse.Namespace, settings: Settings) -> int:
     inbox_dir = settings.receipts_root / "inbox" / store
     processed_dir = settings.receipts_root / "processed" / store
     failed_dir = settings.receipts_root / "failed" / store
@@ -76,7 +139,7 @@ def process_store(store: str, args: argparse.Namespace) -> int:
     db_client = None
     if not args.dry_run and not args.no_db:
         if settings.supabase_url and settings.supabase_key:
-            db_client = SupabaseClient(
+            db_client = _get_supabase_client(
                 settings.supabase_url,
                 settings.supabase_key,
                 settings.receipts_table,
@@ -96,45 +159,97 @@ def process_store(store: str, args: argparse.Namespace) -> int:
         "total_discount": 0.0,
     }
 
-    for i in range(0, len(images), max(1, args.batch_size)):
-        batch = images[i : i + max(1, args.batch_size)]
-        for img in batch:
-            result = process_image(
-                img,
-                store,
-                settings,
-                parser,
-                db_client,
-                dry_run=args.dry_run,
-                no_db=args.no_db,
-                move_files=not args.no_move,
-                write_json_files=not args.no_json,
-            )
-            results.append(result)
-            if not result.db_result.ok:
-                db_errors.append(result.db_result.error or "unknown db error")
-
-            if result.outcome == "processed":
-                if result.status == "warn":
-                    metrics["warn"] += 1
+    # Source hashes already in the DB (or inserted earlier in this run), fetched per batch.
+    known_hashes: set = set()
+    batch_size = max(1, args.batch_size)
+    batches = [images[i : i + batch_size] for i in range(0, len(images), batch_size)]
+    with ThreadPoolExecutor(max_workers=_HASH_WORKERS) as hash_pool, _parse_pool(args.workers, batch_size) as parse_pool:
+
+        def submit_parses(batch):
+            return [parse_pool.submit(_parse_in_worker, img, store) for img in batch]
+
+        # With --workers > 1, OCR + parse runs one batch ahead in the process pool, so it overlaps
+        # the DB writes, moves and logs of the current batch here; at most two batches are in flight.
+        pending = submit_parses(batches[0])
+        # All images are queued for hashing up front, so later batches' hashes are
+        # ready (or nearly) by the time their DB lookup runs.
+        hashes = [
+            hash_pool.submit(_hash_image, img, settings.trust_filename_hash) if db_client else None
+            for img in images
+        ]
+        for n, batch in enumerate(batches):
+            parses = pending
+            if n + 1 < len(batches):
+                pending = submit_parses(batches[n + 1])
+            hash_values = [
+                source_hash.result() if source_hash else None
+                for source_hash in hashes[n * batch_size : (n + 1) * batch_size]
+            ]
+            batch_known = None
+            if db_client and settings.owner_id:
+                try:
+                    known_hashes.update(
+                        db_client.fetch_existing_hashes(settings.owner_id, store, [h for h in hash_values if h])
+                    )
+                    batch_known = known_hashes
+                except Exception as exc:
+                    # Without the prefetch, each file inserts its own receipt row; ON CONFLICT DO NOTHING
+                    # still reports known receipts as duplicates.
+                    _log_line(settings.logs_root, f"[WARN] {store} | existing-hash lookup failed: {exc}")
+            prepared = [
+                prepare_image(
+                    img,
+                    store,
+                    settings,
+                    parser,
+                    db_client,
+                    dry_run=args.dry_run,
+                    no_db=args.no_db,
+                    source_hash=source_hash,
+                    parsed=parsed.result(),
+                    known_hashes=batch_known,
+                )
+                for img, source_hash, parsed in zip(batch, hash_values, parses)
+            ]
+            # One receipts insert and paged items inserts per batch instead of per receipt.
+            if batch_known is not None:
+                insert_prepared_receipts(prepared, db_client, settings.owner_id, batch_known)
+            insert_prepared_items(prepared, db_client)
+            for entry in prepared:
+                result = finalize_image(
+                    entry,
+                    store,
+                    settings,
+                    dry_run=args.dry_run,
+                    no_db=args.no_db,
+                    move_files=not args.no_move,
+                    write_json_files=not args.no_json,
+                )
+                results.append(result)
+                if not result.db_result.ok:
+                    db_errors.append(result.db_result.error or "unknown db error")
+
+                if result.outcome == "processed":
+                    if result.status == "warn":
+                        metrics["warn"] += 1
+                    else:
+                        metrics["success"] += 1
                 else:
-                    metrics["success"] += 1
-            else:
-                metrics["failed"] += 1
-
-            if result.db_result.skipped and not (args.dry_run or args.no_db):
-                metrics["duplicates"] += 1
-
-            metrics["total_items"] += result.items_count
-            if result.total:
-                metrics["total_value"] += float(result.total)
-            if result.discount_total:
-                metrics["total_discount"] += float(result.discount_total)
-
-            _log_line(
-                settings.logs_root,
-                f"[FILE] {store} | {result.file_name} | parse={result.status} | {result.message}",
-            )
+                    metrics["failed"] += 1
+
+                if result.db_result.skipped and not (args.dry_run or args.no_db):
+                    metrics["duplicates"] += 1
+
+                metrics["total_items"] += result.items_count
+                if result.total:
+                    metrics["total_value"] += float(result.total)
+                if result.discount_total:
+                    metrics["total_discount"] += float(result.discount_total)
+
+                _log_line(
+                    settings.logs_root,
+                    f"[FILE] {store} | {result.file_name} | parse={result.status} | {result.message}",
+                )
 
     run_status = "ok"
     if db_errors:
@@ -161,9 +276,13 @@ def main() -> int:
         raise SystemExit("Use --store <name> or --all")
 
     stores = list_stores() if args.all else [args.store]
+    settings = _load_settings(args)
     exit_code = 0
-    for store in stores:
-        exit_code = max(exit_code, process_store(store, args))
+    try:
+        for store in stores:
+            exit_code = max(exit_code, process_store(store, args, settings))
+    finally:
+        close_logs()
     return exit_code
 
 
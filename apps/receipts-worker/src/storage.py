@@ -1,14 +1,25 @@
 import datetime as dt
+import errno
 import json
+import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Set
+
+try:
+    import orjson
+except Exception:
+    orjson = None
 
 from .core import DbResult
 
 
 IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".heic"}
 
+# Unique index on receipts; rows conflicting on it are left alone (INSERT ... ON CONFLICT DO NOTHING).
+RECEIPTS_CONFLICT_KEY = "owner_id,store,source_hash"
+
 
 def ensure_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
@@ -17,20 +28,35 @@ def ensure_dir(path: Path) -> None:
 def list_images(folder: Path) -> List[Path]:
     if not folder.exists():
         return []
-    return sorted(
-        p for p in folder.iterdir()
-        if p.is_file() and p.suffix.lower() in IMAGE_EXTS
-    )
+    # scandir entries carry the file type from the directory read, so is_file() rarely stats.
+    with os.scandir(folder) as entries:
+        return sorted(
+            Path(e.path) for e in entries
+            if os.path.splitext(e.name)[1].lower() in IMAGE_EXTS and e.is_file()
+        )
 
 
 def move_file(src: Path, dst_dir: Path) -> Path:
     ensure_dir(dst_dir)
     dst = dst_dir / src.name
-    return Path(shutil.move(str(src), str(dst)))
+    # inbox/ and processed|failed/ normally share a filesystem: one rename syscall.
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        return Path(shutil.move(str(src), str(dst)))
+    return dst
 
 
 def write_json(path: Path, payload: dict) -> None:
     ensure_dir(path.parent)
+    if orjson is not None:
+        path.write_bytes(
+            orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+            + b"\n"
+        )
+        return
     with path.open("w", encoding="utf-8") as f:
         json.dump(payload, f, ensure_ascii=True, indent=2, sort_keys=True)
         f.write("\n")
@@ -55,35 +81,61 @@ class SupabaseClient:
         self.receipt_items_table = receipt_items_table
         self.apps_table = apps_table
 
-    def receipt_exists(self, owner_id: str, store: str, source_hash: str) -> bool:
-        resp = (
+    def fetch_existing_hashes(self, owner_id: str, store: str, hashes: List[str]) -> Set[str]:
+        """Return the subset of hashes that already have a receipt row, in 200-hash queries."""
+        wanted = list(dict.fromkeys(h for h in hashes if h))
+        existing: Set[str] = set()
+        batch_size = 200
+        for i in range(0, len(wanted), batch_size):
+            batch = wanted[i : i + batch_size]
+            resp = (
+                self.client.table(self.receipts_table)
+                .select("source_hash")
+                .eq("owner_id", owner_id)
+                .eq("store", store)
+                .in_("source_hash", batch)
+                .execute()
+            )
+            for row in resp.data or []:
+                value = row.get("source_hash")
+                if isinstance(value, str):
+                    existing.add(value)
+        return existing
+
+    def _insert_receipt_rows(self, rows):
+        # Only newly inserted rows come back; rows that already exist return nothing.
+        return (
             self.client.table(self.receipts_table)
-            .select("id")
-            .eq("owner_id", owner_id)
-            .eq("store", store)
-            .eq("source_hash", source_hash)
-            .limit(1)
+            .upsert(rows, on_conflict=RECEIPTS_CONFLICT_KEY, ignore_duplicates=True)
             .execute()
         )
-        return bool(resp.data)
 
     def insert_receipt(self, payload: dict) -> DbResult:
         try:
-            resp = self.client.table(self.receipts_table).insert(payload).execute()
-            receipt_id = None
-            if resp.data:
-                receipt_id = resp.data[0].get("id")
-            return DbResult(ok=True, skipped=False, receipt_id=receipt_id)
+            resp = self._insert_receipt_rows(payload)
+            if not resp.data:
+                return DbResult(ok=True, skipped=True)
+            return DbResult(ok=True, skipped=False, receipt_id=resp.data[0].get("id"))
         except Exception as exc:
             return DbResult(ok=False, skipped=False, error=str(exc))
 
-    def upsert_receipt(self, payload: dict, owner_id: str, store: str, source_hash: str) -> DbResult:
+    def bulk_insert_receipts(self, payloads: List[dict]) -> List[DbResult]:
+        """Insert several receipt rows with one request; one DbResult per payload, in order."""
+        if not payloads:
+            return []
         try:
-            if self.receipt_exists(owner_id, store, source_hash):
-                return DbResult(ok=True, skipped=True)
-            return self.insert_receipt(payload)
+            resp = self._insert_receipt_rows(payloads)
         except Exception as exc:
-            return DbResult(ok=False, skipped=False, error=str(exc))
+            return [DbResult(ok=False, skipped=False, error=str(exc)) for _ in payloads]
+        # Match returned rows by source_hash rather than relying on response order;
+        # a payload with no returned row already existed (e.g. inserted by another worker).
+        ids = {row.get("source_hash"): row.get("id") for row in resp.data or []}
+        return [
+            DbResult(ok=True, skipped=False, receipt_id=ids[payload.get("source_hash")])
+            if payload.get("source_hash") in ids
+            else DbResult(ok=True, skipped=True)
+            for payload in payloads
+        ]
 
     def insert_items(self, items: list) -> DbResult:
         if not items:
@@ -96,7 +148,7 @@ class SupabaseClient:
 
     def update_app_status(self, slug: str, status: str, last_error: Optional[str]) -> DbResult:
         update = {"status": status}
-        update["last_run_at"] = dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        update["last_run_at"] = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
         if last_error:
             update["last_error"] = last_error
         try:
@@ -108,24 +160,24 @@ class SupabaseClient:
     def fetch_item_food_hints(self, owner_id: str, names: List[str]) -> dict:
         if not names:
             return {}
-        cleaned = [name.strip() for name in names if isinstance(name, str) and name.strip()]
+        # Receipts repeat product names; query each distinct name only once.
+        cleaned = list(dict.fromkeys(name.strip() for name in names if isinstance(name, str) and name.strip()))
         if not cleaned:
             return {}
 
-        hints: dict = {}
         batch_size = 200
-        for i in range(0, len(cleaned), batch_size):
-            batch = cleaned[i : i + batch_size]
-            resp = (
-                self.client.table(self.receipt_items_table)
-                .select("name,is_food,food_quality,created_at")
-                .eq("owner_id", owner_id)
-                .in_("name", batch)
-                .order("created_at", desc=True)
-                .limit(2000)
-                .execute()
-            )
-            for row in resp.data or []:
+        batches = [cleaned[i : i + batch_size] for i in range(0, len(cleaned), batch_size)]
+        if len(batches) == 1:
+            chunks = [self._fetch_hint_chunk(owner_id, batches[0])]
+        else:
+            # Chunks are independent queries; overlap their round trips.
+            with ThreadPoolExecutor(max_workers=min(8, len(batches))) as pool:
+                chunks = list(pool.map(lambda batch: self._fetch_hint_chunk(owner_id, batch), batches))
+
+        hints: dict = {}
+        # Merge in chunk order so the first (newest) row per name still wins.
+        for rows in chunks:
+            for row in rows:
                 name = row.get("name")
                 if not isinstance(name, str):
                     continue
@@ -137,3 +189,15 @@ class SupabaseClient:
                     "food_quality": row.get("food_quality"),
                 }
         return hints
+
+    def _fetch_hint_chunk(self, owner_id: str, names: List[str]) -> list:
+        resp = (
+            self.client.table(self.receipt_items_table)
+            .select("name,is_food,food_quality,created_at")
+            .eq("owner_id", owner_id)
+            .in_("name", names)
+            .order("created_at", desc=True)
+            .limit(2000)
+            .execute()
+        )
+        return resp.data or []